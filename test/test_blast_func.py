@@ -12,11 +12,14 @@ not, see <http://www.gnu.org/licenses/>.
 """
 
 import unittest
+import unittest.mock
 import os
 import shutil
 import unicycler.misc
 import unicycler.blast_func
+import unicycler.settings
 import unicycler.assembly_graph_segment
+import unicycler.string_graph
 
 
 class TestBlastFunc(unittest.TestCase):
@@ -83,3 +86,277 @@ class TestBlastFunc(unittest.TestCase):
 
         self.assertEqual(len(seg.forward_sequence), length_before_rotate)
         self.assertTrue(seg.forward_sequence.startswith('ATGCAGGAACGCATTAAAGCGTGCTTTACCGAAAG'))
+
+    def test_chunked_search_matches_single_search(self):
+        # Forces the chunked tblastn search (one query per chunk), as used when tblastn can't
+        # thread by query itself.
+        for seq_name in ['random_seq_with_exact_gene_forward_strand',
+                         'random_seq_with_exact_gene_reverse_strand']:
+            seq = [x for x in self.fasta if x[0] == seq_name][0][1]
+            single_hit = unicycler.blast_func.find_start_gene(seq, self.start_genes,
+                                                              self.start_gene_id,
+                                                              self.start_gene_cov, self.blast_dir,
+                                                              'makeblastdb', 'tblastn', 1)
+            with unittest.mock.patch.object(unicycler.settings, 'BLAST_QUERY_CHUNK_SIZE', 1), \
+                    unittest.mock.patch('unicycler.blast_func.tblastn_supports_mt_mode',
+                                        return_value=False):
+                chunked_hit = unicycler.blast_func.find_start_gene(seq, self.start_genes,
+                                                                   self.start_gene_id,
+                                                                   self.start_gene_cov,
+                                                                   self.blast_dir, 'makeblastdb',
+                                                                   'tblastn', 3)
+            self.assertEqual(chunked_hit.qseqid, single_hit.qseqid)
+            self.assertEqual(chunked_hit.start_pos, single_hit.start_pos)
+            self.assertEqual(chunked_hit.flip, single_hit.flip)
+
+    def test_chunked_search_no_start_gene(self):
+        seq = [x for x in self.fasta if x[0] == 'random_seq_no_start_gene'][0][1]
+        with unittest.mock.patch.object(unicycler.settings, 'BLAST_QUERY_CHUNK_SIZE', 1), \
+                unittest.mock.patch('unicycler.blast_func.tblastn_supports_mt_mode',
+                                    return_value=False):
+            with self.assertRaises(unicycler.blast_func.CannotFindStart):
+                unicycler.blast_func.find_start_gene(seq, self.start_genes, self.start_gene_id,
+                                                     self.start_gene_cov, self.blast_dir,
+                                                     'makeblastdb', 'tblastn', 3)
+
+    def test_duplicate_start_genes(self):
+        # Duplicated start genes are removed before the search (so the remaining queries go to
+        # tblastn on stdin) and the first copy's name is the one reported.
+        duplicates = os.path.join(os.path.dirname(__file__),
+                                  'test_blast_func_start_genes_duplicates.fasta')
+        for seq_name in ['random_seq_with_exact_gene_forward_strand',
+                         'random_seq_with_exact_gene_reverse_strand']:
+            seq = [x for x in self.fasta if x[0] == seq_name][0][1]
+            hit = unicycler.blast_func.find_start_gene(seq, self.start_genes, self.start_gene_id,
+                                                       self.start_gene_cov, self.blast_dir,
+                                                       'makeblastdb', 'tblastn')
+            dup_hit = unicycler.blast_func.find_start_gene(seq, duplicates, self.start_gene_id,
+                                                           self.start_gene_cov, self.blast_dir,
+                                                           'makeblastdb', 'tblastn')
+            self.assertEqual(dup_hit.qseqid, 'P66818_first_copy')
+            self.assertEqual(dup_hit.start_pos, hit.start_pos)
+            self.assertEqual(dup_hit.flip, hit.flip)
+
+
+class TestRotateSequence(unittest.TestCase):
+    """
+    Tests rotation of segments when both strands are stored, where the reverse strand is rotated
+    instead of being rebuilt.
+    """
+
+    def setUp(self):
+        self.seq = unicycler.misc.get_random_sequence(100)
+        self.start_positions = [0, 1, 37, 50, 99, 100]
+
+    def check_rotation(self, seg, start_pos, flip):
+        seg.rotate_sequence(start_pos, flip)
+        rotated_seq = self.seq[start_pos:] + self.seq[:start_pos]
+        rev_comp_rotated_seq = unicycler.misc.reverse_complement(rotated_seq)
+        if flip:
+            self.assertEqual(seg.forward_sequence, rev_comp_rotated_seq)
+            self.assertEqual(seg.reverse_sequence, rotated_seq)
+        else:
+            self.assertEqual(seg.forward_sequence, rotated_seq)
+            self.assertEqual(seg.reverse_sequence, rev_comp_rotated_seq)
+
+    def test_assembly_graph_segment(self):
+        for start_pos in self.start_positions:
+            for flip in [False, True]:
+                seg = unicycler.assembly_graph_segment.Segment(1, 1.0, self.seq, True)
+                seg.build_other_sequence_if_necessary()
+                self.check_rotation(seg, start_pos, flip)
+
+    def test_assembly_graph_segment_one_strand(self):
+        for start_pos in self.start_positions:
+            for flip in [False, True]:
+                seg = unicycler.assembly_graph_segment.Segment(1, 1.0, self.seq, True)
+                self.check_rotation(seg, start_pos, flip)
+
+    def test_string_graph_segment(self):
+        for start_pos in self.start_positions:
+            for flip in [False, True]:
+                seg = unicycler.string_graph.StringGraphSegment('1', self.seq)
+                self.check_rotation(seg, start_pos, flip)
+
+
+class TestDuplicateQueries(unittest.TestCase):
+    """
+    Tests the removal of repeated start genes and the FASTA passed to tblastn on stdin.
+    """
+
+    def setUp(self):
+        duplicates = os.path.join(os.path.dirname(__file__),
+                                  'test_blast_func_start_genes_duplicates.fasta')
+        self.queries = unicycler.misc.load_fasta(duplicates)
+
+    def test_first_copy_kept(self):
+        unique = unicycler.blast_func.remove_duplicate_queries(self.queries)
+        self.assertEqual([name for name, _ in unique],
+                         ['P66818_first_copy', 'UniRef90_A7ZPT9', 'UniRef90_Q8XBZ3'])
+        self.assertEqual(len(set(seq for _, seq in unique)), 3)
+
+    def test_no_duplicates(self):
+        queries = [('a', 'MAA'), ('b', 'MCC'), ('c', 'MGG')]
+        self.assertEqual(unicycler.blast_func.remove_duplicate_queries(queries), queries)
+
+    def test_empty(self):
+        self.assertEqual(unicycler.blast_func.remove_duplicate_queries([]), [])
+
+    def test_queries_to_fasta(self):
+        queries = [('a', 'MAA'), ('b', 'MCC')]
+        self.assertEqual(unicycler.blast_func.queries_to_fasta(queries),
+                         b'>a\nMAA\n>b\nMCC\n')
+
+    def test_queries_to_fasta_round_trip(self):
+        unique = unicycler.blast_func.remove_duplicate_queries(self.queries)
+        fasta = os.path.join(os.path.dirname(__file__), 'TEMP_' + str(os.getpid()) + '.fasta')
+        try:
+            with open(fasta, 'wb') as f:
+                f.write(unicycler.blast_func.queries_to_fasta(unique))
+            self.assertEqual(unicycler.misc.load_fasta(fasta), unique)
+        finally:
+            if os.path.exists(fasta):
+                os.remove(fasta)
+
+
+class TestSplitIntoChunks(unittest.TestCase):
+    """
+    Tests the splitting of start gene queries into chunks for parallel tblastn searches.
+    """
+
+    def test_even_split(self):
+        self.assertEqual(unicycler.blast_func.split_into_chunks(list(range(6)), 3),
+                         [[0, 1], [2, 3], [4, 5]])
+
+    def test_uneven_split(self):
+        # The remainder goes to the first chunks, one item each.
+        self.assertEqual(unicycler.blast_func.split_into_chunks(list(range(11)), 4),
+                         [[0, 1, 2], [3, 4, 5], [6, 7, 8], [9, 10]])
+
+    def test_one_chunk(self):
+        self.assertEqual(unicycler.blast_func.split_into_chunks(list(range(5)), 1),
+                         [[0, 1, 2, 3, 4]])
+
+    def test_one_item_per_chunk(self):
+        self.assertEqual(unicycler.blast_func.split_into_chunks(['a', 'b', 'c'], 3),
+                         [['a'], ['b'], ['c']])
+
+    def test_order_preserved(self):
+        items = [('gene_' + str(i), 'MKV' * (i + 1)) for i in range(2631)]
+        for chunk_count in [2, 3, 7, 8, 26]:
+            chunks = unicycler.blast_func.split_into_chunks(items, chunk_count)
+            self.assertEqual(len(chunks), chunk_count)
+            self.assertEqual([x for chunk in chunks for x in chunk], items)
+            chunk_sizes = [len(chunk) for chunk in chunks]
+            self.assertTrue(max(chunk_sizes) - min(chunk_sizes) <= 1)
+
+
+def blast_line(qseqid='gene', sstart=101, send=400, pident=100.0, qlen=100, length=100,
+               qstart=1, bitscore=200.0):
+    """
+    Builds a line of tblastn output (in the format find_start_gene asks for) as bytes.
+    """
+    parts = [qseqid, sstart, send, pident, qlen, length, qstart, bitscore]
+    return ('\t'.join(str(x) for x in parts) + '\n').encode()
+
+
+class TestGetBestHit(unittest.TestCase):
+    """
+    Tests the selection of the best start gene hit from tblastn output lines.
+    """
+
+    def get_best_hit(self, lines):
+        return unicycler.blast_func.get_best_hit(lines, 90.0, 95.0, 10000)
+
+    def test_single_hit(self):
+        hit, bitscore = self.get_best_hit([blast_line()])
+        self.assertEqual(hit.qseqid, 'gene')
+        self.assertEqual(hit.start_pos, 100)
+        self.assertFalse(hit.flip)
+        self.assertEqual(hit.pident, 100.0)
+        self.assertEqual(hit.query_cov, 100.0)
+        self.assertEqual(bitscore, 200.0)
+
+    def test_reverse_strand_hit(self):
+        hit, _ = self.get_best_hit([blast_line(sstart=400, send=101)])
+        self.assertEqual(hit.start_pos, 400)
+        self.assertTrue(hit.flip)
+
+    def test_no_hits(self):
+        self.assertEqual(self.get_best_hit([]), (None, 0))
+
+    def test_qstart_not_at_gene_start(self):
+        self.assertEqual(self.get_best_hit([blast_line(qstart=2)]), (None, 0))
+        hit, _ = self.get_best_hit([blast_line(qseqid='a', qstart=2, bitscore=500.0),
+                                    blast_line(qseqid='b', qstart=1, bitscore=100.0)])
+        self.assertEqual(hit.qseqid, 'b')
+
+    def test_highest_bitscore_wins(self):
+        hit, bitscore = self.get_best_hit([blast_line(qseqid='a', bitscore=100.0),
+                                           blast_line(qseqid='b', bitscore=300.0),
+                                           blast_line(qseqid='c', bitscore=200.0)])
+        self.assertEqual(hit.qseqid, 'b')
+        self.assertEqual(bitscore, 300.0)
+
+    def test_equal_bitscore_earlier_hit_wins(self):
+        hit, _ = self.get_best_hit([blast_line(qseqid='a', bitscore=200.0),
+                                    blast_line(qseqid='b', bitscore=200.0)])
+        self.assertEqual(hit.qseqid, 'a')
+
+    def test_identity_at_threshold(self):
+        hit, _ = self.get_best_hit([blast_line(pident=90.0)])
+        self.assertEqual(hit.pident, 90.0)
+        self.assertEqual(self.get_best_hit([blast_line(pident=89.999)]), (None, 0))
+
+    def test_coverage_at_threshold(self):
+        hit, _ = self.get_best_hit([blast_line(qlen=100, length=95)])
+        self.assertEqual(hit.query_cov, 95.0)
+        self.assertEqual(self.get_best_hit([blast_line(qlen=100, length=94)]), (None, 0))
+
+    def test_failing_hit_does_not_replace_best(self):
+        hit, _ = self.get_best_hit([blast_line(qseqid='a', bitscore=100.0),
+                                    blast_line(qseqid='b', bitscore=300.0, pident=80.0),
+                                    blast_line(qseqid='c', bitscore=300.0, length=50)])
+        self.assertEqual(hit.qseqid, 'a')
+
+    def test_short_and_blank_lines(self):
+        lines = [b'', b'\n', b'gene\t101\t400\n', blast_line(qseqid='a'), b'']
+        hit, _ = self.get_best_hit(lines)
+        self.assertEqual(hit.qseqid, 'a')
+        self.assertEqual(self.get_best_hit([b'', b'\n', b'gene\t101\n']), (None, 0))
+
+
+class TestTblastnVersion(unittest.TestCase):
+    """
+    Tests the tblastn version check for multi-threading by query.
+    """
+
+    def setUp(self):
+        unicycler.blast_func.TBLASTN_MT_MODE_SUPPORT.clear()
+
+    def tearDown(self):
+        unicycler.blast_func.TBLASTN_MT_MODE_SUPPORT.clear()
+
+    def supports_mt_mode(self, version):
+        with unittest.mock.patch('unicycler.blast_func.tblastn_path_and_version',
+                                 return_value=('tblastn', version, 'good')):
+            return unicycler.blast_func.tblastn_supports_mt_mode('tblastn')
+
+    def test_old_version(self):
+        self.assertFalse(self.supports_mt_mode('2.14.1+'))
+
+    def test_new_version(self):
+        self.assertTrue(self.supports_mt_mode('2.15.0+'))
+
+    def test_newer_version(self):
+        self.assertTrue(self.supports_mt_mode('3.0.0+'))
+
+    def test_unknown_version(self):
+        self.assertFalse(self.supports_mt_mode('?'))
+
+    def test_not_found(self):
+        self.assertFalse(self.supports_mt_mode(''))
+
+    def test_version_is_cached(self):
+        self.assertTrue(self.supports_mt_mode('2.15.0+'))
+        self.assertTrue(self.supports_mt_mode('2.14.1+'))
@@ -64,6 +64,11 @@ class TestMiscFunctions(unittest.TestCase):
         self.assertEqual('tgACBWDARAYACHASKGVTMACnG',
                          unicycler.misc.reverse_complement('CnGTKABCMSTDGTRTYTHWVGTca'))
 
+    def test_reverse_complement_unknown_characters(self):
+        self.assertEqual('NNNT', unicycler.misc.reverse_complement('AXZ*'))
+        self.assertEqual('N.-N', unicycler.misc.reverse_complement('É-.!'))
+        self.assertEqual('ANNT', unicycler.misc.reverse_complement('A\nxT'))
+
     def test_get_random_base(self):
         a_count, c_count, g_count, t_count, other_count = 0, 0, 0, 0, 0
         for i in range(10000):
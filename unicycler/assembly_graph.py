@@ -2089,8 +2089,9 @@ class AssemblyGraph(object):
         # Segments which are equal to the overlap size cannot have the larger trim applied to
         # both sides, so we require that edges on opposite sides of these segments to be grouped
         # together.
-        small_seg_nums = [x for x in pos_and_neg_seg_nums
-                          if self.segments[abs(x)].get_length() == self.overlap]
+        small_seg_nums = [num for num, seg in self.segments.items()
+                          if seg.get_length() == self.overlap]
+        small_seg_nums += [-x for x in small_seg_nums]
         for seg in small_seg_nums:
             downstream_segs = self.get_downstream_seg_nums(seg)
             upstream_segs = self.get_upstream_seg_nums(seg)
@@ -201,7 +201,16 @@ class Segment(object):
         """
         unrotated_seq = self.forward_sequence
         rotated_seq = unrotated_seq[start_pos:] + unrotated_seq[:start_pos]
-        rev_comp_rotated_seq = reverse_complement(rotated_seq)
+
+        # The reverse complement of the rotated sequence is just the existing reverse sequence
+        # rotated the other way, so we only need to build it from scratch if we don't have it.
+        unrotated_rev_seq = self.reverse_sequence
+        if len(unrotated_rev_seq) == len(unrotated_seq):
+            rev_start_pos = len(unrotated_seq) - start_pos
+            rev_comp_rotated_seq = unrotated_rev_seq[rev_start_pos:] + \
+                unrotated_rev_seq[:rev_start_pos]
+        else:
+            rev_comp_rotated_seq = reverse_complement(rotated_seq)
 
         if flip:
             self.forward_sequence = rev_comp_rotated_seq
@@ -16,8 +16,14 @@ not, see <http://www.gnu.org/licenses/>.
 
 import os
 import subprocess
-from .misc import load_fasta
+import threading
+from multiprocessing.dummy import Pool as ThreadPool
+from .misc import load_fasta, tblastn_path_and_version
 from . import log
+from . import settings
+
+# tblastn is run once per completed replicon, so we only check its version once per executable.
+TBLASTN_MT_MODE_SUPPORT = {}
 
 
 class CannotFindStart(Exception):
@@ -25,7 +31,7 @@ class CannotFindStart(Exception):
 
 
 def find_start_gene(sequence, start_genes_fasta, identity_threshold, coverage_threshold, blast_dir,
-                    makeblastdb_path, tblastn_path):
+                    makeblastdb_path, tblastn_path, threads=1):
     """
     This function uses tblastn to look for start genes in the sequence. It returns the first gene
     (using the order in the file) which meets the identity and coverage thresholds, as well as
@@ -40,6 +46,17 @@ def find_start_gene(sequence, start_genes_fasta, identity_threshold, coverage_th
     queries = load_fasta(start_genes_fasta)
     if not queries:
         raise CannotFindStart
+
+    # Identical start genes give identical hits, and a hit never replaces an earlier one with the
+    # same bitscore, so only the first copy of each sequence needs to be searched. If any were
+    # removed, the remaining queries are piped to tblastn instead of it reading the file.
+    unique_queries = remove_duplicate_queries(queries)
+    if len(unique_queries) < len(queries):
+        queries = unique_queries
+        query_arg, query_fasta = '-', queries_to_fasta(queries)
+    else:
+        query_arg, query_fasta = start_genes_fasta, None
+
     longest_query = max(len(x[1]) for x in queries)
     longest_query *= 3  # amino acids to nucleotides
     dup_length = min(seq_len, longest_query)
@@ -53,52 +70,222 @@ def find_start_gene(sequence, start_genes_fasta, identity_threshold, coverage_th
     starting_dir = os.getcwd()
     os.chdir(blast_dir)
 
-    # Create a FASTA file of the replicon sequence.
-    replicon_fasta_filename = 'replicon.fasta'
-    replicon_fasta = open(replicon_fasta_filename, 'w')
-    replicon_fasta.write('>replicon\n')
-    replicon_fasta.write(sequence)
-    replicon_fasta.write('\n')
-    replicon_fasta.close()
+    # The BLAST runs are closed when we're done, so no tblastn process is left running if anything
+    # goes wrong while reading their output.
+    blast_runs = []
+    try:
+        # Build the BLAST database. The replicon sequence is piped straight into makeblastdb, so
+        # we don't need to write it to a FASTA file first. The FASTA header and sequence are
+        # written separately to avoid making another copy of the (possibly multi-megabase)
+        # sequence. The writing happens in its own thread (on a pipe Popen doesn't manage), so
+        # communicate can read makeblastdb's stdout and stderr at the same time.
+        replicon_db_name = 'replicon'
+        command = [makeblastdb_path, '-dbtype', 'nucl', '-in', '-', '-out', replicon_db_name,
+                   '-title', 'replicon']
+        log.log('  ' + ' '.join(command), 2)
+        stdin_read, stdin_write = os.pipe()
+        try:
+            process = subprocess.Popen(command, stdin=stdin_read, stdout=subprocess.PIPE,
+                                       stderr=subprocess.PIPE)
+        except OSError:
+            os.close(stdin_write)
+            raise
+        finally:
+            os.close(stdin_read)
+        writer = threading.Thread(target=write_and_close,
+                                  args=(os.fdopen(stdin_write, 'wb'), b'>replicon\n',
+                                        sequence.encode(), b'\n'))
+        writer.start()
+        _, err = process.communicate()
+        writer.join()
+        if err:
+            log.log('\nmakeblastdb encountered an error:\n' + err.decode())
+            raise CannotFindStart
 
-    # Build the BLAST database.
-    command = [makeblastdb_path, '-dbtype', 'nucl', '-in', replicon_fasta_filename]
-    log.log('  ' + ' '.join(command), 2)
-    process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    _, err = process.communicate()
-    if err:
-        log.log('\nmakeblastdb encountered an error:\n' + err.decode())
+        # Run the tblastn search. We have lots of queries (the start genes) and a tiny database
+        # (one replicon), so BLAST's own threading (which splits the database) doesn't help much.
+        # If tblastn is new enough, we ask it to split the work between threads by query instead.
+        # Otherwise we do the same thing ourselves by splitting the queries into chunks and
+        # running a single-threaded tblastn process on each chunk at the same time. Either way,
+        # the tblastn output is parsed as it is produced, so it never needs to be held in memory.
+        many_queries = len(queries) >= settings.BLAST_MT_MODE_MIN_QUERY_COUNT
+        if threads > 1 and many_queries and tblastn_supports_mt_mode(tblastn_path):
+            command = tblastn_command(tblastn_path, replicon_db_name, query_arg,
+                                      threads) + ['-mt_mode', '1']
+            blast_runs.append(run_tblastn(command, query_fasta))
+            best_hit, best_bitscore = get_best_hit(blast_runs[0], identity_threshold,
+                                                   coverage_threshold, seq_len)
+        elif threads > 1 and len(queries) >= 2 * settings.BLAST_QUERY_CHUNK_SIZE:
+            chunk_count = min(threads, len(queries) // settings.BLAST_QUERY_CHUNK_SIZE)
+            command = tblastn_command(tblastn_path, replicon_db_name, '-', 1)
+            blast_runs += [run_tblastn(command, queries_to_fasta(chunk))
+                           for chunk in split_into_chunks(queries, chunk_count)]
+            jobs = [(blast_run, identity_threshold, coverage_threshold, seq_len)
+                    for blast_run in blast_runs]
+            pool = ThreadPool(chunk_count)
+            try:
+                chunk_best_hits = pool.starmap(get_best_hit, jobs)
+            finally:
+                pool.close()
+                pool.join()
+
+            # The chunks are in query order, so taking the first best hit gives the same result as
+            # a single tblastn search would have.
+            best_hit, best_bitscore = None, 0
+            for hit, bitscore in chunk_best_hits:
+                if bitscore > best_bitscore:
+                    best_hit, best_bitscore = hit, bitscore
+        else:
+            command = tblastn_command(tblastn_path, replicon_db_name, query_arg, threads)
+            blast_runs.append(run_tblastn(command, query_fasta))
+            best_hit, best_bitscore = get_best_hit(blast_runs[0], identity_threshold,
+                                                   coverage_threshold, seq_len)
+    finally:
+        for blast_run in blast_runs:
+            blast_run.close()
         os.chdir(starting_dir)
+
+    if best_bitscore:
+        return best_hit
+    else:
         raise CannotFindStart
 
-    # Run the tblastn search.
-    command = [tblastn_path, '-db', replicon_fasta_filename, '-query', start_genes_fasta, '-outfmt',
-               '6 qseqid sstart send pident qlen qseq qstart bitscore', '-num_threads', '1']
+
+def tblastn_command(tblastn_path, db, query_file, threads):
+    return [tblastn_path, '-db', db, '-query', query_file, '-outfmt',
+            '6 qseqid sstart send pident qlen length qstart bitscore', '-num_threads', str(threads)]
+
+
+def run_tblastn(command, query_fasta=None):
+    """
+    Runs a tblastn command, yielding its (tabular) output lines as they are produced. If the
+    command reads its queries from stdin, they are given here as FASTA-formatted bytes.
+    """
     log.log('  ' + ' '.join(command), 2)
-    process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    blast_out, blast_err = process.communicate()
-    process.wait()
-    if blast_err:
-        log.log('\nBLAST encountered an error:\n' + blast_err.decode())
+    process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                               stderr=subprocess.PIPE)
+
+    # Feeding stdin and collecting stderr happen in their own threads, so tblastn can't block on
+    # a full pipe while we're reading its stdout.
+    blast_err = []
+    helper_threads = [threading.Thread(target=lambda: blast_err.append(process.stderr.read())),
+                      threading.Thread(target=write_and_close, args=(process.stdin, query_fasta))]
+    for thread in helper_threads:
+        thread.start()
+
+    # If the caller stops reading early (e.g. because of an exception), tblastn is killed so it
+    # doesn't keep running in the background.
+    finished = False
+    try:
+        for line in process.stdout:
+            yield line
+        finished = True
+    finally:
+        if not finished:
+            process.kill()
+        process.wait()
+        process.stdout.close()
+        for thread in helper_threads:
+            thread.join()
+        process.stderr.close()
+    if blast_err[0]:
+        log.log('\nBLAST encountered an error:\n' + blast_err[0].decode())
+
+
+def write_and_close(pipe, *data):
+    """
+    Writes the given bytes to a process's stdin and then closes it. If the process quits before
+    reading it all, its error will be in stderr, so a broken pipe is ignored.
+    """
+    try:
+        for piece in data:
+            if piece:
+                pipe.write(piece)
+    except BrokenPipeError:
+        pass
+    finally:
+        try:
+            pipe.close()
+        except BrokenPipeError:
+            pass
 
-    # Find the best hit in the results.
+
+def get_best_hit(blast_lines, identity_threshold, coverage_threshold, seq_len):
+    """
+    Returns the best tblastn hit (and its bitscore) which meets the identity and coverage
+    thresholds and starts at the start of its gene. Ties go to the earlier hit. The lines are
+    checked directly as raw bytes, and only lines which beat the current best hit are made into
+    BlastHit objects.
+    """
     best_hit, best_bitscore = None, 0
-    for line in blast_out.decode().splitlines():
-        hit = BlastHit(line, seq_len)
-        if hit.pident >= identity_threshold and hit.query_cov >= coverage_threshold and \
-                hit.qstart == 0 and hit.bitscore > best_bitscore:
-            best_hit = hit
-            best_bitscore = hit.bitscore
+    for line in blast_lines:
+        parts = line.split(b'\t')
+        if len(parts) < 8:
+            continue
+        # Most hits fail the cheaper checks, so those are done first.
+        if int(parts[6]) != 1:  # qstart
+            continue
+        bitscore = float(parts[7])
+        if bitscore <= best_bitscore or float(parts[3]) < identity_threshold:  # pident
+            continue
+        query_cov = 100.0 * int(parts[5]) / float(parts[4])
+        if query_cov >= coverage_threshold:
+            best_hit = BlastHit(line.decode(), seq_len)
+            best_bitscore = bitscore
+    return best_hit, best_bitscore
 
-    os.chdir(starting_dir)
 
-    if best_bitscore:
-        return best_hit
-    else:
-        raise CannotFindStart
+def remove_duplicate_queries(queries):
+    """
+    Returns the (name, seq) queries without any repeated sequences, keeping the first of each.
+    """
+    seen_seqs = set()
+    unique_queries = []
+    for name, seq in queries:
+        if seq not in seen_seqs:
+            seen_seqs.add(seq)
+            unique_queries.append((name, seq))
+    return unique_queries
+
+
+def queries_to_fasta(queries):
+    """
+    Returns the (name, seq) queries as FASTA-formatted bytes, for piping into tblastn.
+    """
+    return ''.join(['>' + name + '\n' + seq + '\n' for name, seq in queries]).encode()
+
+
+def split_into_chunks(items, chunk_count):
+    """
+    Splits a list into the given number of contiguous chunks (as evenly sized as possible), so
+    results from the chunks can be joined back together in the original order.
+    """
+    chunk_size, remainder = divmod(len(items), chunk_count)
+    chunks, start = [], 0
+    for i in range(chunk_count):
+        end = start + chunk_size + (1 if i < remainder else 0)
+        chunks.append(items[start:end])
+        start = end
+    return chunks
+
+
+def tblastn_supports_mt_mode(tblastn_path):
+    """
+    Returns whether this tblastn is recent enough to use multi-threading by query (-mt_mode 1).
+    """
+    if tblastn_path not in TBLASTN_MT_MODE_SUPPORT:
+        _, version, _ = tblastn_path_and_version(tblastn_path)
+        try:
+            major, minor = int(version.split('.')[0]), int(version.split('.')[1])
+            supported = (major, minor) >= settings.BLAST_MT_MODE_MIN_VERSION
+        except (ValueError, IndexError):
+            supported = False
+        TBLASTN_MT_MODE_SUPPORT[tblastn_path] = supported
+    return TBLASTN_MT_MODE_SUPPORT[tblastn_path]
 
 
 class BlastHit(object):
+    __slots__ = ('qseqid', 'pident', 'qstart', 'bitscore', 'query_cov', 'start_pos', 'flip')
 
     def __init__(self, blast_line, seq_len):
         self.qseqid = ''
@@ -115,8 +302,8 @@ class BlastHit(object):
             sstart = int(parts[1]) - 1
             send = int(parts[2])
             qlen = float(parts[4])
-            qseq = parts[5]
-            self.query_cov = 100.0 * len(qseq) / qlen
+            length = int(parts[5])
+            self.query_cov = 100.0 * length / qlen
 
             if sstart <= send:
                 self.start_pos = sstart
@@ -39,6 +39,18 @@ REV_COMP_DICT = {'A': 'T', 'T': 'A', 'G': 'C', 'C': 'G',
                  'd': 'h', 'h': 'd', 'n': 'n',
                  '.': '.', '-': '-', '?': '?'}
 
+
+class RevCompTable(dict):
+    """
+    A str.translate table for REV_COMP_DICT which (like complement_base) turns any other character
+    into an N.
+    """
+    def __missing__(self, key):
+        return 'N'
+
+
+REV_COMP_TABLE = RevCompTable(str.maketrans(REV_COMP_DICT))
+
 RANDOM_SEQ_DICT = {0: 'A', 1: 'C', 2: 'G', 3: 'T'}
 
 
@@ -216,7 +228,7 @@ def reverse_complement(seq):
     """
     Given a DNA sequences, this function returns the reverse complement sequence.
     """
-    return ''.join([complement_base(x) for x in seq][::-1])
+    return seq.translate(REV_COMP_TABLE)[::-1]
 
 
 def complement_base(base):
@@ -181,3 +181,13 @@ REQUIRED_MINIASM_ASSEMBLY_SIZE_FOR_BRIDGING = 0.5
 # limits the amount of trimming it's willing to do. I.e. if miniasm trimmed more than this from a
 # contig, Unicycler won't.
 MAX_MINIASM_DEAD_END_TRIM_SIZE = 100
+
+# When searching for start genes, tblastn can split its work between threads by query instead of by
+# database (-mt_mode 1), which is much faster when there are many queries and a small database. We
+# only use this mode on BLAST versions which pick a good threading strategy for it.
+BLAST_MT_MODE_MIN_VERSION = (2, 15)
+BLAST_MT_MODE_MIN_QUERY_COUNT = 100
+
+# If tblastn can't thread by query itself, Unicycler splits the start genes into chunks of at least
+# this many queries and runs a single-threaded tblastn on each chunk in parallel.
+BLAST_QUERY_CHUNK_SIZE = 100
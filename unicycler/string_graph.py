@@ -595,7 +595,12 @@ class StringGraphSegment(object):
         """
         unrotated_seq = self.forward_sequence
         rotated_seq = unrotated_seq[start_pos:] + unrotated_seq[:start_pos]
-        rev_comp_rotated_seq = reverse_complement(rotated_seq)
+
+        # The reverse complement of the rotated sequence is just the existing reverse sequence
+        # rotated the other way, so there's no need to build it from scratch.
+        rev_start_pos = len(unrotated_seq) - start_pos
+        rev_comp_rotated_seq = self.reverse_sequence[rev_start_pos:] + \
+            self.reverse_sequence[:rev_start_pos]
 
         if flip:
             self.forward_sequence = rev_comp_rotated_seq